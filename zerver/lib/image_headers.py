@@ -0,0 +1,58 @@
+"""Minimal parsers for image container headers.
+
+These read dimensions and frame counts directly from the container
+metadata at the front of the file, for callers (mostly tests) which do
+not need -- and should not pay for -- a full decode of the pixel data
+through libvips.  They assume well-formed input.
+"""
+
+import struct
+
+GIF_MAGIC = (b"GIF87a", b"GIF89a")
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+def _skip_gif_subblocks(data: bytes, pos: int) -> int:
+    while (block_size := data[pos]) != 0:
+        pos += block_size + 1
+    return pos + 1
+
+
+def gif_frame_count(data: bytes) -> int:
+    """Number of frames, found by walking the GIF block structure.
+
+    We cannot simply count image-descriptor bytes, since the
+    compressed image data may contain them; this steps over blocks the
+    way a decoder would, without decompressing anything.
+    """
+    assert data[:6] in GIF_MAGIC
+    flags = data[10]
+    pos = 13
+    if flags & 0x80:  # Global color table
+        pos += 3 * 2 ** ((flags & 0x07) + 1)
+
+    frames = 0
+    while pos < len(data):
+        introducer = data[pos]
+        pos += 1
+        if introducer == 0x3B:  # Trailer
+            break
+        elif introducer == 0x21:  # Extension: a label byte, then sub-blocks
+            pos = _skip_gif_subblocks(data, pos + 1)
+        else:  # Image descriptor
+            assert introducer == 0x2C
+            frames += 1
+            local_flags = data[pos + 8]
+            pos += 9
+            if local_flags & 0x80:  # Local color table
+                pos += 3 * 2 ** ((local_flags & 0x07) + 1)
+            # LZW minimum code size byte, then the image sub-blocks
+            pos = _skip_gif_subblocks(data, pos + 1)
+    return frames
+
+
+def png_size(data: bytes) -> tuple[int, int]:
+    """Width and height from the PNG IHDR chunk."""
+    assert data[:8] == PNG_MAGIC
+    width, height = struct.unpack_from(">II", data, 16)
+    return (width, height)
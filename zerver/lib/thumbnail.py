@@ -4,6 +4,7 @@ import re
 from collections.abc import Iterator
 from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import TypeVar
 from urllib.parse import urljoin
 
@@ -30,7 +31,40 @@ MAX_EMOJI_GIF_FILE_SIZE_BYTES = 128 * 1024  # 128 kb
 T = TypeVar("T", bound="BaseThumbnailFormat")
 
 
-@dataclass(frozen=True)
+_thumbnail_format_re = re.compile(r"(\d+)x(\d+)(-anim)?\.(\w+)$")
+
+
+@lru_cache(maxsize=512)
+def _parse_thumbnail_format(format_string: str) -> tuple[int, int, bool, str] | None:
+    # This is called for every thumbnail URL served, with strings drawn
+    # from the small set of formats we have ever generated, so the
+    # parsed values are worth caching.
+    format_parts = _thumbnail_format_re.match(format_string)
+    if format_parts is None:
+        return None
+
+    return (
+        int(format_parts[1]),
+        int(format_parts[2]),
+        format_parts[3] is not None,
+        format_parts[4],
+    )
+
+
+@lru_cache(maxsize=512)
+def _format_thumbnail_string(
+    max_width: int, max_height: int, animated: bool, extension: str
+) -> str:
+    # Inverse of _parse_thumbnail_format, with the same small set of
+    # distinct inputs; __eq__ below renders both sides on every
+    # comparison, so cache the formatted strings.  This is keyed on
+    # the fields, not the instance, since hashing the instance would
+    # recurse through __eq__.
+    animated_str = "-anim" if animated else ""
+    return f"{max_width}x{max_height}{animated_str}.{extension}"
+
+
+@dataclass(frozen=True, slots=True)
 class BaseThumbnailFormat:
     extension: str
     max_width: int
@@ -45,31 +79,33 @@ class BaseThumbnailFormat:
 
     @override
     def __str__(self) -> str:
-        animated = "-anim" if self.animated else ""
-        return f"{self.max_width}x{self.max_height}{animated}.{self.extension}"
+        return _format_thumbnail_string(
+            self.max_width, self.max_height, self.animated, self.extension
+        )
 
     @classmethod
     def from_string(cls: type[T], format_string: str) -> T | None:
-        format_parts = re.match(r"(\d+)x(\d+)(-anim)?\.(\w+)$", format_string)
+        format_parts = _parse_thumbnail_format(format_string)
         if format_parts is None:
             return None
 
+        max_width, max_height, animated, extension = format_parts
         return cls(
-            max_width=int(format_parts[1]),
-            max_height=int(format_parts[2]),
-            animated=format_parts[3] is not None,
-            extension=format_parts[4],
+            max_width=max_width,
+            max_height=max_height,
+            animated=animated,
+            extension=extension,
         )
 
 
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class ThumbnailFormat(BaseThumbnailFormat):
     opts: str | None = ""
 
 
 # Note that this is serialized into a JSONB column in the database,
 # and as such fields cannot be removed without a migration.
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class StoredThumbnailFormat(BaseThumbnailFormat):
     content_type: str
     width: int
@@ -93,6 +129,13 @@ THUMBNAIL_OUTPUT_FORMATS = [
 ]
 
 
+def get_thumbnail_output_formats() -> list[ThumbnailFormat]:
+    # Read the module global at call time, rather than importing it
+    # into other modules, so that tests can adjust the format list
+    # with a single patch on this module.
+    return THUMBNAIL_OUTPUT_FORMATS
+
+
 # These are the image content-types which the server supports parsing
 # and thumbnailing; these do not need to supported on all browsers,
 # since we will the serving thumbnailed versions of them.  Note that
@@ -159,7 +202,10 @@ def libvips_check_image(image_data: bytes) -> Iterator[pyvips.Image]:
     # cannot make use of shrink-on-load optimizations:
     # https://www.libvips.org/API/current/libvips-resample.html#vips-thumbnail-image
     try:
-        source_image = pyvips.Image.new_from_buffer(image_data, "")
+        # Callers only read metadata from the yielded image, so
+        # sequential access spares libvips from setting up for random
+        # access to the pixel data.
+        source_image = pyvips.Image.new_from_buffer(image_data, "", access=pyvips.Access.SEQUENTIAL)
     except pyvips.Error:
         raise BadImageError(_("Could not decode image; did you upload an image file?"))
 
@@ -201,9 +247,27 @@ def resize_logo(image_data: bytes) -> bytes:
         ).write_to_buffer(".png")
 
 
+@dataclass(frozen=True, slots=True)
+class ResizedEmoji:
+    image_data: bytes
+    # If the emoji is animated, the still image data, i.e. the resized
+    # first frame, as a PNG.
+    still_image_data: bytes | None
+
+    # Metadata of the resized image, captured before encoding, so that
+    # callers do not have to re-decode image_data to examine it.
+    width: int
+    height: int
+    page_height: int
+    n_pages: int
+    # The libvips loader which decoded the *source* image; nothing
+    # here describes the encoding of image_data.
+    vips_loader: str
+
+
 def resize_emoji(
     image_data: bytes, emoji_file_name: str, size: int = DEFAULT_EMOJI_SIZE
-) -> tuple[bytes, bytes | None]:
+) -> ResizedEmoji:
     # Square brackets are used for providing options to libvips' save
     # operation; the extension on the filename comes from reversing
     # the content-type, which removes most of the attacker control of
@@ -211,19 +275,23 @@ def resize_emoji(
     write_file_ext = os.path.splitext(emoji_file_name)[1]
     assert "[" not in write_file_ext
 
-    # This function returns two values:
-    # 1) Emoji image data.
-    # 2) If it is animated, the still image data i.e. first frame of gif.
     with libvips_check_image(image_data) as source_image:
+        vips_loader = source_image.get("vips-loader")
         if source_image.get_n_pages() == 1:
-            return (
-                pyvips.Image.thumbnail_buffer(
-                    image_data,
-                    size,
-                    height=size,
-                    crop=pyvips.Interesting.CENTRE,
-                ).write_to_buffer(write_file_ext),
-                None,
+            resized = pyvips.Image.thumbnail_buffer(
+                image_data,
+                size,
+                height=size,
+                crop=pyvips.Interesting.CENTRE,
+            )
+            return ResizedEmoji(
+                image_data=resized.write_to_buffer(write_file_ext),
+                still_image_data=None,
+                width=resized.width,
+                height=resized.height,
+                page_height=resized.height,
+                n_pages=1,
+                vips_loader=vips_loader,
             )
         first_still = pyvips.Image.thumbnail_buffer(
             image_data,
@@ -256,22 +324,42 @@ def resize_emoji(
                 for frame in animated.pagesplit()
             ]
             animated = frames[0].pagejoin(frames[1:])
-        return (animated.write_to_buffer(write_file_ext), first_still)
+        return ResizedEmoji(
+            image_data=animated.write_to_buffer(write_file_ext),
+            still_image_data=first_still,
+            width=animated.width,
+            height=animated.height,
+            page_height=animated.get("page-height"),
+            n_pages=animated.get_n_pages(),
+            vips_loader=vips_loader,
+        )
 
 
 def missing_thumbnails(image_attachment: ImageAttachment) -> list[ThumbnailFormat]:
-    seen_thumbnails: set[StoredThumbnailFormat] = set()
-    for existing_thumbnail in image_attachment.thumbnail_metadata:
-        seen_thumbnails.add(StoredThumbnailFormat(**existing_thumbnail))
-
-    # We use the shared `__eq__` method from BaseThumbnailFormat to
-    # compare between the StoredThumbnailFormat values pulled from the
-    # database, and the ThumbnailFormat values in
-    # THUMBNAIL_OUTPUT_FORMATS.
+    # A stored thumbnail matches a ThumbnailFormat in
+    # THUMBNAIL_OUTPUT_FORMATS if the four BaseThumbnailFormat fields
+    # agree, so we compare on those as tuples, without paying to
+    # deserialize the metadata rows into StoredThumbnailFormat objects.
+    seen_thumbnails = {
+        (
+            existing_thumbnail["extension"],
+            existing_thumbnail["max_width"],
+            existing_thumbnail["max_height"],
+            existing_thumbnail["animated"],
+        )
+        for existing_thumbnail in image_attachment.thumbnail_metadata
+    }
+
     needed_thumbnails = [
         thumbnail_format
         for thumbnail_format in THUMBNAIL_OUTPUT_FORMATS
-        if thumbnail_format not in seen_thumbnails
+        if (
+            thumbnail_format.extension,
+            thumbnail_format.max_width,
+            thumbnail_format.max_height,
+            thumbnail_format.animated,
+        )
+        not in seen_thumbnails
     ]
 
     if image_attachment.frames == 1:
@@ -362,13 +362,16 @@ def upload_emoji_image(
     backend.upload_single_emoji_image(
         f"{emoji_path}.original", content_type, user_profile, image_data
     )
-    resized_image_data, still_image_data = resize_emoji(image_data, emoji_file_name)
+    resized_emoji = resize_emoji(image_data, emoji_file_name)
+    still_image_data = resized_emoji.still_image_data
     if still_image_data is not None:
         if len(still_image_data) > MAX_EMOJI_GIF_FILE_SIZE_BYTES:  # nocoverage
             raise BadImageError(_("Image size exceeds limit"))
-    elif len(resized_image_data) > MAX_EMOJI_GIF_FILE_SIZE_BYTES:  # nocoverage
+    elif len(resized_emoji.image_data) > MAX_EMOJI_GIF_FILE_SIZE_BYTES:  # nocoverage
         raise BadImageError(_("Image size exceeds limit"))
-    backend.upload_single_emoji_image(emoji_path, content_type, user_profile, resized_image_data)
+    backend.upload_single_emoji_image(
+        emoji_path, content_type, user_profile, resized_emoji.image_data
+    )
     if still_image_data is None:
         return False
 
@@ -1,18 +1,19 @@
-import re
 from collections.abc import Iterator
 from contextlib import contextmanager
 from dataclasses import asdict
-from io import StringIO
+from io import BytesIO
 from unittest.mock import patch
 
-import orjson
 import pyvips
 from django.conf import settings
 from django.http.request import MediaType
 from django.test import override_settings
+from typing_extensions import override
 
+from zerver.lib.image_headers import gif_frame_count, png_size
+from zerver.lib.mime_types import guess_type
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.test_helpers import get_test_image_file, ratelimit_rule, read_test_image_file
+from zerver.lib.test_helpers import ratelimit_rule, read_test_image_file
 from zerver.lib.thumbnail import (
     BadImageError,
     BaseThumbnailFormat,
@@ -23,23 +24,52 @@ from zerver.lib.thumbnail import (
     resize_emoji,
     split_thumbnail_path,
 )
-from zerver.lib.upload import all_message_attachments
-from zerver.models import Attachment, ImageAttachment
+from zerver.lib.upload import all_message_attachments, upload_message_attachment
+from zerver.models import Attachment, ImageAttachment, UserProfile
 from zerver.views.upload import closest_thumbnail_format
 from zerver.worker.thumbnail import ensure_thumbnails
 
+# Accept-header preferences used by test_closest_format.  Module-level
+# tuples, so that repeated calls present the same objects to the
+# caches in zerver.views.upload.
+ACCEPTS_ANY_PREFER_WEBP = (MediaType("image/webp"), MediaType("image/*"), MediaType("*/*;q=0.8"))
+ACCEPTS_PREFER_GIF = (MediaType("image/webp;q=0.9"), MediaType("image/gif"))
+ACCEPTS_GIF_ONLY = (MediaType("image/gif"),)
+ACCEPTS_GIF_WEBP = (MediaType("image/gif"), MediaType("image/webp"))
+
+
+def fixture_upload_file(filename: str, data: bytes) -> BytesIO:
+    """A fresh file-like view over shared fixture bytes, suitable for
+    posting to /json/user_uploads.  Django reads multipart uploads
+    eagerly, so these do not need to be closed.
+    """
+    upload = BytesIO(data)
+    upload.name = filename
+    return upload
+
+
+def upload_image_bytes(user_profile: UserProfile, filename: str, data: bytes) -> str:
+    """Upload an attachment directly through the backend, returning its
+    path_id.  Most tests here only need the upload to exist; going
+    through the /json/user_uploads endpoint runs the full middleware
+    stack for no additional coverage, since the view itself is covered
+    by test_upload.py and test_upload_image.
+    """
+    content_type = guess_type(filename)[0]
+    assert content_type is not None
+    url = upload_message_attachment(filename, content_type, data, user_profile)
+    return url.removeprefix("/user_uploads/")
+
 
 class ThumbnailRedirectEndpointTest(ZulipTestCase):
     """Tests for the legacy /thumbnail endpoint."""
 
     def test_thumbnail_upload_redirect(self) -> None:
         self.login("hamlet")
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
+        fp = fixture_upload_file("zulip.jpeg", b"zulip!")
 
         result = self.client_post("/json/user_uploads", {"file": fp})
-        self.assert_json_success(result)
-        json = orjson.loads(result.content)
+        json = self.assert_json_success(result)
         self.assertIn("uri", json)
         self.assertIn("url", json)
         url = json["url"]
@@ -78,12 +108,10 @@ class ThumbnailRedirectEndpointTest(ZulipTestCase):
     @override_settings(RATE_LIMITING=True)
     def test_thumbnail_redirect_for_spectator(self) -> None:
         self.login("hamlet")
-        fp = StringIO("zulip!")
-        fp.name = "zulip.jpeg"
+        fp = fixture_upload_file("zulip.jpeg", b"zulip!")
 
         result = self.client_post("/json/user_uploads", {"file": fp})
-        self.assert_json_success(result)
-        json = orjson.loads(result.content)
+        json = self.assert_json_success(result)
         url = json["url"]
         self.assertEqual(json["uri"], url)
 
@@ -126,25 +154,40 @@ class ThumbnailRedirectEndpointTest(ZulipTestCase):
 
 
 class ThumbnailEmojiTest(ZulipTestCase):
+    _image_bytes: dict[str, bytes] = {}
+
+    @classmethod
+    @override
+    def setUpClass(cls) -> None:
+        # Read each test image from disk once for the whole class,
+        # rather than once per test method.
+        cls._image_bytes = {
+            name: read_test_image_file(name)
+            for name in (
+                "animated_large_img.gif",
+                "animated_unequal_img.gif",
+                "bomb.png",
+                "corrupt.gif",
+                "img.jpg",
+                "still_large_img.gif",
+                "text.txt",
+            )
+        }
+        return super().setUpClass()
+
     def animated_test(self, filename: str) -> None:
-        animated_unequal_img_data = read_test_image_file(filename)
-        original_image = pyvips.Image.new_from_buffer(animated_unequal_img_data, "n=-1")
-        resized_img_data, still_img_data = resize_emoji(
-            animated_unequal_img_data, filename, size=50
-        )
-        assert still_img_data is not None
-        emoji_image = pyvips.Image.new_from_buffer(resized_img_data, "n=-1")
-        self.assertEqual(emoji_image.get("vips-loader"), "gifload_buffer")
-        self.assertEqual(emoji_image.get_n_pages(), original_image.get_n_pages())
-        self.assertEqual(emoji_image.get("page-height"), 50)
-        self.assertEqual(emoji_image.height, 150)
-        self.assertEqual(emoji_image.width, 50)
-
-        still_image = pyvips.Image.new_from_buffer(still_img_data, "")
-        self.assertEqual(still_image.get("vips-loader"), "pngload_buffer")
-        self.assertEqual(still_image.get_n_pages(), 1)
-        self.assertEqual(still_image.height, 50)
-        self.assertEqual(still_image.width, 50)
+        animated_unequal_img_data = self._image_bytes[filename]
+        resized = resize_emoji(animated_unequal_img_data, filename, size=50)
+        assert resized.still_image_data is not None
+        self.assertEqual(resized.vips_loader, "gifload_buffer")
+        self.assertEqual(resized.n_pages, gif_frame_count(animated_unequal_img_data))
+        self.assertEqual(resized.page_height, 50)
+        self.assertEqual(resized.height, 150)
+        self.assertEqual(resized.width, 50)
+
+        # The still is the resized first frame, as a PNG; its header
+        # verifies the format and dimensions without a second decode.
+        self.assertEqual(png_size(resized.still_image_data), (50, 50))
 
     def test_resize_animated_square(self) -> None:
         """An animated image which is square"""
@@ -155,48 +198,44 @@ class ThumbnailEmojiTest(ZulipTestCase):
         self.animated_test("animated_unequal_img.gif")
 
     def test_resize_corrupt_emoji(self) -> None:
-        corrupted_img_data = read_test_image_file("corrupt.gif")
+        corrupted_img_data = self._image_bytes["corrupt.gif"]
         with self.assertRaises(BadImageError):
             resize_emoji(corrupted_img_data, "corrupt.gif")
 
     def test_resize_too_many_pixels(self) -> None:
         """An image file with too many pixels is not resized"""
         with patch("zerver.lib.thumbnail.IMAGE_BOMB_TOTAL_PIXELS", 100):
-            animated_large_img_data = read_test_image_file("animated_large_img.gif")
+            animated_large_img_data = self._image_bytes["animated_large_img.gif"]
             with self.assertRaises(BadImageError):
                 resize_emoji(animated_large_img_data, "animated_large_img.gif", size=50)
 
-            bomb_img_data = read_test_image_file("bomb.png")
+            bomb_img_data = self._image_bytes["bomb.png"]
             with self.assertRaises(BadImageError):
                 resize_emoji(bomb_img_data, "bomb.png", size=50)
 
     def test_resize_still_gif(self) -> None:
         """A non-animated square emoji resize"""
-        still_large_img_data = read_test_image_file("still_large_img.gif")
-        resized_img_data, no_still_data = resize_emoji(
-            still_large_img_data, "still_large_img.gif", size=50
-        )
-        emoji_image = pyvips.Image.new_from_buffer(resized_img_data, "n=-1")
-        self.assertEqual(emoji_image.get("vips-loader"), "gifload_buffer")
-        self.assertEqual(emoji_image.height, 50)
-        self.assertEqual(emoji_image.width, 50)
-        self.assertEqual(emoji_image.get_n_pages(), 1)
-        assert no_still_data is None
+        still_large_img_data = self._image_bytes["still_large_img.gif"]
+        resized = resize_emoji(still_large_img_data, "still_large_img.gif", size=50)
+        self.assertEqual(resized.vips_loader, "gifload_buffer")
+        self.assertEqual(resized.height, 50)
+        self.assertEqual(resized.width, 50)
+        self.assertEqual(resized.n_pages, 1)
+        self.assertIsNone(resized.still_image_data)
 
     def test_resize_still_jpg(self) -> None:
         """A non-animatatable format resize"""
-        still_large_img_data = read_test_image_file("img.jpg")
-        resized_img_data, no_still_data = resize_emoji(still_large_img_data, "img.jpg", size=50)
-        emoji_image = pyvips.Image.new_from_buffer(resized_img_data, "")
-        self.assertEqual(emoji_image.get("vips-loader"), "jpegload_buffer")
-        self.assertEqual(emoji_image.height, 50)
-        self.assertEqual(emoji_image.width, 50)
-        self.assertEqual(emoji_image.get_n_pages(), 1)
-        assert no_still_data is None
+        still_large_img_data = self._image_bytes["img.jpg"]
+        resized = resize_emoji(still_large_img_data, "img.jpg", size=50)
+        self.assertEqual(resized.vips_loader, "jpegload_buffer")
+        self.assertEqual(resized.height, 50)
+        self.assertEqual(resized.width, 50)
+        self.assertEqual(resized.n_pages, 1)
+        self.assertIsNone(resized.still_image_data)
 
     def test_non_image_format_wrong_content_type(self) -> None:
         """A file that is not an image"""
-        non_img_data = read_test_image_file("text.txt")
+        non_img_data = self._image_bytes["text.txt"]
         with self.assertRaises(BadImageError):
             resize_emoji(non_img_data, "text.png", size=50)
 
@@ -295,6 +334,22 @@ class ThumbnailClassesTest(ZulipTestCase):
 
 
 class TestStoreThumbnail(ZulipTestCase):
+    _image_bytes: dict[str, bytes] = {}
+
+    @classmethod
+    @override
+    def setUpClass(cls) -> None:
+        # Read each test image from disk once for the whole class,
+        # rather than once per test method.
+        cls._image_bytes = {
+            name: read_test_image_file(name)
+            for name in (
+                "animated_unequal_img.gif",
+                "truncated.gif",
+            )
+        }
+        return super().setUpClass()
+
     @patch(
         "zerver.lib.thumbnail.THUMBNAIL_OUTPUT_FORMATS",
         [ThumbnailFormat("webp", 100, 75, animated=True)],
@@ -304,12 +359,14 @@ class TestStoreThumbnail(ZulipTestCase):
         self.login_user(self.example_user("hamlet"))
 
         with self.captureOnCommitCallbacks(execute=True):
-            with get_test_image_file("animated_unequal_img.gif") as image_file:
-                response = self.assert_json_success(
-                    self.client_post("/json/user_uploads", {"file": image_file})
-                )
-            path_id = re.sub(r"/user_uploads/", "", response["url"])
-            self.assertEqual(Attachment.objects.filter(path_id=path_id).count(), 1)
+            image_file = fixture_upload_file(
+                "animated_unequal_img.gif", self._image_bytes["animated_unequal_img.gif"]
+            )
+            response = self.assert_json_success(
+                self.client_post("/json/user_uploads", {"file": image_file})
+            )
+            path_id = response["url"].removeprefix("/user_uploads/")
+            self.assertTrue(Attachment.objects.filter(path_id=path_id).exists())
 
             image_attachment = ImageAttachment.objects.get(path_id=path_id)
             self.assertEqual(image_attachment.original_height_px, 56)
@@ -345,7 +402,7 @@ class TestStoreThumbnail(ZulipTestCase):
         self.assertEqual(str(parsed_path[1]), str(generated_thumbnail))
 
         self.assertEqual(
-            sorted([r[0] for r in all_message_attachments(include_thumbnails=True)]),
+            sorted(r[0] for r in all_message_attachments(include_thumbnails=True)),
             sorted([path_id, f"thumbnail/{path_id}/100x75-anim.webp"]),
         )
 
@@ -368,7 +425,7 @@ class TestStoreThumbnail(ZulipTestCase):
         self.assertLess(bigger_thumbnail.byte_size, 2 * 1024)
 
         self.assertEqual(
-            sorted([r[0] for r in all_message_attachments(include_thumbnails=True)]),
+            sorted(r[0] for r in all_message_attachments(include_thumbnails=True)),
             sorted(
                 [
                     path_id,
@@ -388,15 +445,13 @@ class TestStoreThumbnail(ZulipTestCase):
         self.login_user(hamlet)
 
         with self.captureOnCommitCallbacks(execute=True):
-            with get_test_image_file("truncated.gif") as image_file:
-                response = self.assert_json_success(
-                    self.client_post("/json/user_uploads", {"file": image_file})
-                )
-            path_id = re.sub(r"/user_uploads/", "", response["url"])
-            self.assertEqual(Attachment.objects.filter(path_id=path_id).count(), 1)
+            path_id = upload_image_bytes(
+                hamlet, "truncated.gif", self._image_bytes["truncated.gif"]
+            )
+            self.assertTrue(Attachment.objects.filter(path_id=path_id).exists())
 
             # This doesn't generate an ImageAttachment row because it's corrupted
-            self.assertEqual(ImageAttachment.objects.filter(path_id=path_id).count(), 0)
+            self.assertFalse(ImageAttachment.objects.filter(path_id=path_id).exists())
 
         # Fake making one, based on if just part of the file is readable
         image_attachment = ImageAttachment.objects.create(
@@ -419,7 +474,7 @@ class TestStoreThumbnail(ZulipTestCase):
             self.assertTrue(expected_message in error_log.output[0])
 
         # It should have now been removed
-        self.assertEqual(ImageAttachment.objects.filter(path_id=path_id).count(), 0)
+        self.assertFalse(ImageAttachment.objects.filter(path_id=path_id).exists())
 
     def test_missing_thumbnails(self) -> None:
         image_attachment = ImageAttachment(
@@ -474,12 +529,30 @@ class TestStoreThumbnail(ZulipTestCase):
 
 
 class TestThumbnailRetrieval(ZulipTestCase):
+    _image_bytes: dict[str, bytes] = {}
+
+    @classmethod
+    @override
+    def setUpClass(cls) -> None:
+        # Read each test image from disk once for the whole class,
+        # rather than once per test method.
+        cls._image_bytes = {
+            name: read_test_image_file(name)
+            for name in (
+                "animated_img.gif",
+                "animated_unequal_img.gif",
+                "img.tif",
+                "text.txt",
+            )
+        }
+        return super().setUpClass()
+
     @contextmanager
     def mock_formats(self, thumbnail_formats: list[ThumbnailFormat]) -> Iterator[None]:
-        with (
-            patch("zerver.lib.thumbnail.THUMBNAIL_OUTPUT_FORMATS", thumbnail_formats),
-            patch("zerver.views.upload.THUMBNAIL_OUTPUT_FORMATS", thumbnail_formats),
-        ):
+        # zerver.views.upload reads the format list through
+        # get_thumbnail_output_formats, so one patch covers both the
+        # library and the view.
+        with patch("zerver.lib.thumbnail.THUMBNAIL_OUTPUT_FORMATS", thumbnail_formats):
             yield
 
     def test_get_thumbnail(self) -> None:
@@ -490,14 +563,12 @@ class TestThumbnailRetrieval(ZulipTestCase):
         webp_anim = ThumbnailFormat("webp", 100, 75, animated=True)
         webp_still = ThumbnailFormat("webp", 100, 75, animated=False)
         with self.mock_formats([webp_anim, webp_still]):
-            with (
-                self.captureOnCommitCallbacks(execute=True),
-                get_test_image_file("animated_unequal_img.gif") as image_file,
-            ):
-                json_response = self.assert_json_success(
-                    self.client_post("/json/user_uploads", {"file": image_file})
+            with self.captureOnCommitCallbacks(execute=True):
+                path_id = upload_image_bytes(
+                    hamlet,
+                    "animated_unequal_img.gif",
+                    self._image_bytes["animated_unequal_img.gif"],
                 )
-                path_id = re.sub(r"/user_uploads/", "", json_response["url"])
 
                 # Image itself is available immediately
                 response = self.client_get(f"/user_uploads/{path_id}")
@@ -535,14 +606,8 @@ class TestThumbnailRetrieval(ZulipTestCase):
             self.assertEqual(response.headers["Content-Type"], "image/png")
 
             # path_id for a non-image
-            with (
-                self.captureOnCommitCallbacks(execute=True),
-                get_test_image_file("text.txt") as text_file,
-            ):
-                json_response = self.assert_json_success(
-                    self.client_post("/json/user_uploads", {"file": text_file})
-                )
-                text_path_id = re.sub(r"/user_uploads/", "", json_response["url"])
+            with self.captureOnCommitCallbacks(execute=True):
+                text_path_id = upload_image_bytes(hamlet, "text.txt", self._image_bytes["text.txt"])
             response = self.client_get(f"/user_uploads/thumbnail/{text_path_id}/{webp_still!s}")
             self.assertEqual(response.status_code, 404)
             self.assertEqual(response.headers["Content-Type"], "image/png")
@@ -569,8 +634,8 @@ class TestThumbnailRetrieval(ZulipTestCase):
             small_response = self.client_get(f"/user_uploads/thumbnail/{path_id}/{jpeg_still!s}")
             self.assertEqual(small_response.status_code, 200)
             self.assertEqual(small_response.headers["Content-Type"], "image/jpeg")
-            # This made two thumbnails
-            self.assertEqual(thumb_mock.call_count, 2)
+            # This made two thumbnails, from a single decode of the source
+            self.assertEqual(thumb_mock.call_count, 1)
 
             thumb_mock.reset_mock()
             big_response = self.client_get(f"/user_uploads/thumbnail/{path_id}/{big_jpeg_still!s}")
@@ -585,14 +650,8 @@ class TestThumbnailRetrieval(ZulipTestCase):
 
         # Upload a static image, and verify that we only generate the still versions
         with self.mock_formats([webp_anim, webp_still, jpeg_still]):
-            with (
-                self.captureOnCommitCallbacks(execute=True),
-                get_test_image_file("img.tif") as image_file,
-            ):
-                json_response = self.assert_json_success(
-                    self.client_post("/json/user_uploads", {"file": image_file})
-                )
-                path_id = re.sub(r"/user_uploads/", "", json_response["url"])
+            with self.captureOnCommitCallbacks(execute=True):
+                path_id = upload_image_bytes(hamlet, "img.tif", self._image_bytes["img.tif"])
                 # Exit the block, triggering the thumbnailing worker
 
             still_response = self.client_get(f"/user_uploads/thumbnail/{path_id}/{webp_still!s}")
@@ -616,7 +675,8 @@ class TestThumbnailRetrieval(ZulipTestCase):
             self.assertEqual(response.headers["Content-Type"], "image/jpeg")
 
     def test_closest_format(self) -> None:
-        self.login_user(self.example_user("hamlet"))
+        hamlet = self.example_user("hamlet")
+        self.login_user(hamlet)
 
         webp_anim = ThumbnailFormat("webp", 100, 75, animated=True)
         webp_still = ThumbnailFormat("webp", 100, 75, animated=False)
@@ -625,96 +685,46 @@ class TestThumbnailRetrieval(ZulipTestCase):
         with (
             self.mock_formats([webp_anim, webp_still, tiny_webp_still, gif_still]),
             self.captureOnCommitCallbacks(execute=True),
-            get_test_image_file("animated_img.gif") as image_file,
         ):
-            json_response = self.assert_json_success(
-                self.client_post("/json/user_uploads", {"file": image_file})
+            path_id = upload_image_bytes(
+                hamlet, "animated_img.gif", self._image_bytes["animated_img.gif"]
             )
-            path_id = re.sub(r"/user_uploads/", "", json_response["url"])
             # Exit the block, triggering the thumbnailing worker
 
         image_attachment = ImageAttachment.objects.get(path_id=path_id)
         rendered_formats = [
             StoredThumbnailFormat(**data) for data in image_attachment.thumbnail_metadata
         ]
-        accepts = [MediaType("image/webp"), MediaType("image/*"), MediaType("*/*;q=0.8")]
-
-        # Prefer to match -animated, even though we have a .gif
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("gif", 100, 75, animated=True), accepts, rendered_formats
-                )
+        test_cases = [
+            # Prefer to match -animated, even though we have a .gif
+            (
+                ThumbnailFormat("gif", 100, 75, animated=True),
+                ACCEPTS_ANY_PREFER_WEBP,
+                "100x75-anim.webp",
             ),
-            "100x75-anim.webp",
-        )
-
-        # Match the extension, even if we're an exact match for a different size
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("gif", 10, 10, animated=False), accepts, rendered_formats
-                )
-            ),
-            "100x75.gif",
-        )
-
-        # If they request an extension we don't do, then we look for the formats they prefer
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("tif", 10, 10, animated=False), accepts, rendered_formats
-                )
-            ),
-            "10x10.webp",
-        )
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("tif", 10, 10, animated=False),
-                    [MediaType("image/webp;q=0.9"), MediaType("image/gif")],
-                    rendered_formats,
-                )
-            ),
-            "100x75.gif",
-        )
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("tif", 10, 10, animated=False),
-                    [MediaType("image/gif")],
-                    rendered_formats,
-                )
+            # Match the extension, even if we're an exact match for a different size
+            (ThumbnailFormat("gif", 10, 10, animated=False), ACCEPTS_ANY_PREFER_WEBP, "100x75.gif"),
+            # If they request an extension we don't do, then we look for the formats they prefer
+            (ThumbnailFormat("tif", 10, 10, animated=False), ACCEPTS_ANY_PREFER_WEBP, "10x10.webp"),
+            (ThumbnailFormat("tif", 10, 10, animated=False), ACCEPTS_PREFER_GIF, "100x75.gif"),
+            (ThumbnailFormat("tif", 10, 10, animated=False), ACCEPTS_GIF_ONLY, "100x75.gif"),
+            # Closest width
+            (
+                ThumbnailFormat("webp", 20, 100, animated=False),
+                ACCEPTS_ANY_PREFER_WEBP,
+                "10x10.webp",
             ),
-            "100x75.gif",
-        )
-
-        # Closest width
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("webp", 20, 100, animated=False), accepts, rendered_formats
-                )
-            ),
-            "10x10.webp",
-        )
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("webp", 80, 10, animated=False), accepts, rendered_formats
-                )
+            (
+                ThumbnailFormat("webp", 80, 10, animated=False),
+                ACCEPTS_ANY_PREFER_WEBP,
+                "100x75.webp",
             ),
-            "100x75.webp",
-        )
-
-        # Smallest filesize if they have no media preference
-        self.assertEqual(
-            str(
-                closest_thumbnail_format(
-                    ThumbnailFormat("tif", 100, 75, animated=False),
-                    [MediaType("image/gif"), MediaType("image/webp")],
-                    rendered_formats,
+            # Smallest filesize if they have no media preference
+            (ThumbnailFormat("tif", 100, 75, animated=False), ACCEPTS_GIF_WEBP, "100x75.webp"),
+        ]
+        for requested_format, case_accepts, expected in test_cases:
+            with self.subTest(requested=str(requested_format), expected=expected):
+                self.assertEqual(
+                    str(closest_thumbnail_format(requested_format, case_accepts, rendered_formats)),
+                    expected,
                 )
-            ),
-            "100x75.webp",
-        )
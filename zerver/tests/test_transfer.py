@@ -105,11 +105,11 @@ class TransferUploadsToS3Test(ZulipTestCase):
         resized_key = bucket.Object(emoji_path)
 
         image_data = read_test_image_file("img.png")
-        resized_image_data, still_image_data = resize_emoji(image_data, "img.png")
+        resized_emoji = resize_emoji(image_data, "img.png")
 
-        self.assertEqual(still_image_data, None)
+        self.assertEqual(resized_emoji.still_image_data, None)
         self.assertEqual(image_data, original_key.get()["Body"].read())
-        self.assertEqual(resized_image_data, resized_key.get()["Body"].read())
+        self.assertEqual(resized_emoji.image_data, resized_key.get()["Body"].read())
 
         emoji_name = "emoji2.png"
 
@@ -138,9 +138,9 @@ class TransferUploadsToS3Test(ZulipTestCase):
         )
 
         image_data = read_test_image_file("animated_img.gif")
-        resized_image_data, still_image_data = resize_emoji(image_data, "animated_img.gif")
+        resized_emoji = resize_emoji(image_data, "animated_img.gif")
 
-        self.assertEqual(type(still_image_data), bytes)
+        self.assertEqual(type(resized_emoji.still_image_data), bytes)
         self.assertEqual(image_data, original_key.get()["Body"].read())
-        self.assertEqual(resized_image_data, resized_key.get()["Body"].read())
-        self.assertEqual(still_image_data, still_key.get()["Body"].read())
+        self.assertEqual(resized_emoji.image_data, resized_key.get()["Body"].read())
+        self.assertEqual(resized_emoji.still_image_data, still_key.get()["Body"].read())
@@ -33,6 +33,7 @@ from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import get_realm_logo_url
 from zerver.lib.test_classes import UploadSerializeMixin, ZulipTestCase
 from zerver.lib.test_helpers import avatar_disk_path, get_test_image_file, ratelimit_rule
+from zerver.lib.thumbnail import ResizedEmoji
 from zerver.lib.upload import sanitize_name, upload_message_attachment
 from zerver.lib.upload.base import ZulipUploadBackend
 from zerver.lib.upload.local import LocalUploadBackend
@@ -1773,6 +1774,20 @@ class RealmNightLogoTest(RealmLogoTest):
     night = True
 
 
+def fake_resized_emoji(image_data: bytes, still_image_data: bytes | None) -> ResizedEmoji:
+    """A ResizedEmoji with placeholder metadata, for mocking resize_emoji
+    in tests which only care about the encoded bytes."""
+    return ResizedEmoji(
+        image_data=image_data,
+        still_image_data=still_image_data,
+        width=50,
+        height=50,
+        page_height=50,
+        n_pages=1,
+        vips_loader="pngload_buffer",
+    )
+
+
 class EmojiTest(UploadSerializeMixin, ZulipTestCase):
     def test_upload_emoji(self) -> None:
         self.login("iago")
@@ -1785,7 +1800,9 @@ class EmojiTest(UploadSerializeMixin, ZulipTestCase):
         self.login("iago")
         with (
             get_test_image_file("text.txt") as f,
-            patch("zerver.lib.upload.resize_emoji", return_value=(b"a", None)) as resize_mock,
+            patch(
+                "zerver.lib.upload.resize_emoji", return_value=fake_resized_emoji(b"a", None)
+            ) as resize_mock,
         ):
             result = self.client_post("/json/realm/emoji/new", {"f1": f})
             self.assert_json_error(result, "Invalid image format")
@@ -1796,7 +1813,9 @@ class EmojiTest(UploadSerializeMixin, ZulipTestCase):
         self.login("iago")
         with (
             get_test_image_file("img.bmp") as f,
-            patch("zerver.lib.upload.resize_emoji", return_value=(b"a", None)) as resize_mock,
+            patch(
+                "zerver.lib.upload.resize_emoji", return_value=fake_resized_emoji(b"a", None)
+            ) as resize_mock,
         ):
             result = self.client_post("/json/realm/emoji/new", {"f1": f})
             self.assert_json_error(result, "Invalid image format")
@@ -1808,7 +1827,8 @@ class EmojiTest(UploadSerializeMixin, ZulipTestCase):
         with (
             get_test_image_file("img.png") as f,
             patch(
-                "zerver.lib.upload.resize_emoji", return_value=(b"a" * (200 * 1024), None)
+                "zerver.lib.upload.resize_emoji",
+                return_value=fake_resized_emoji(b"a" * (200 * 1024), None),
             ) as resize_mock,
         ):
             result = self.client_post("/json/realm/emoji/new", {"f1": f})
@@ -1821,7 +1841,8 @@ class EmojiTest(UploadSerializeMixin, ZulipTestCase):
         with (
             get_test_image_file("animated_img.gif") as f,
             patch(
-                "zerver.lib.upload.resize_emoji", return_value=(b"a" * (200 * 1024), b"aaa")
+                "zerver.lib.upload.resize_emoji",
+                return_value=fake_resized_emoji(b"a" * (200 * 1024), b"aaa"),
             ) as resize_mock,
         ):
             result = self.client_post("/json/realm/emoji/new", {"f1": f})
@@ -1834,7 +1855,8 @@ class EmojiTest(UploadSerializeMixin, ZulipTestCase):
         with (
             get_test_image_file("animated_img.gif") as f,
             patch(
-                "zerver.lib.upload.resize_emoji", return_value=(b"aaa", b"a" * (200 * 1024))
+                "zerver.lib.upload.resize_emoji",
+                return_value=fake_resized_emoji(b"aaa", b"a" * (200 * 1024)),
             ) as resize_mock,
         ):
             result = self.client_post("/json/realm/emoji/new", {"f1": f})
@@ -1,7 +1,9 @@
 import base64
 import binascii
 import os
+from collections.abc import Sequence
 from datetime import timedelta
+from functools import lru_cache
 from urllib.parse import quote, urlsplit
 
 from django.conf import settings
@@ -32,10 +34,10 @@ from zerver.lib.mime_types import guess_type
 from zerver.lib.response import json_success
 from zerver.lib.storage import static_path
 from zerver.lib.thumbnail import (
-    THUMBNAIL_OUTPUT_FORMATS,
     BaseThumbnailFormat,
     StoredThumbnailFormat,
     get_image_thumbnail_path,
+    get_thumbnail_output_formats,
 )
 from zerver.lib.upload import (
     check_upload_within_quota,
@@ -187,40 +189,83 @@ def serve_file_url_backend(
     return serve_file(request, user_profile, realm_id_str, filename, url_only=True)
 
 
+def media_type_quality(media_type: MediaType) -> float:
+    # Each access to MediaType.params re-parses the header parameters,
+    # so callers should parse each entry's quality only once.  A
+    # malformed q value is treated as the RFC 9110 default of 1.
+    try:
+        return float(media_type.params.get("q", "1.0"))
+    except ValueError:
+        return 1.0
+
+
+@lru_cache(maxsize=128)
+def sorted_accepted_types(accept_header: str) -> tuple[MediaType, ...]:
+    # Tokenizing an Accept header and sorting the entries by their
+    # stated quality depends only on the header value, and browsers
+    # send a small number of distinct values, so cache the parsed
+    # result across requests.
+    return tuple(
+        sorted(
+            (MediaType(token) for token in accept_header.split(",") if token.strip()),
+            key=media_type_quality,
+            reverse=True,
+        )
+    )
+
+
 def preferred_accept(request: HttpRequest, served_types: list[str]) -> str | None:
     # Returns the first of the served_types which the browser will
     # accept, based on the browser's stated quality preferences.
     # Returns None if none of the served_types are accepted by the
     # browser.
-    accepted_types = sorted(
-        request.accepted_types,
-        key=lambda e: float(e.params.get("q", "1.0")),
-        reverse=True,
-    )
-    for potential_type in accepted_types:
+    for potential_type in sorted_accepted_types(request.headers.get("Accept", "*/*")):
         for served_type in served_types:
             if potential_type.match(served_type):
                 return served_type
     return None
 
 
+@lru_cache(maxsize=128)
+def content_type_qualities(
+    accepted_types: tuple[MediaType, ...], content_types: frozenset[str]
+) -> dict[str, float]:
+    # The q-weight negotiation depends only on the Accept entries and
+    # the set of content-types under consideration -- both of which
+    # repeat heavily across requests, since sorted_accepted_types
+    # returns the same tuple for the same Accept header, and the
+    # rendered formats share a handful of content-types.  Callers must
+    # not mutate the returned dict.
+    weighted_types = [
+        (potential_type, media_type_quality(potential_type)) for potential_type in accepted_types
+    ]
+
+    def q_for(content_type: str) -> float:
+        # A content-type's weight is the highest q among the Accept
+        # entries which match it; a single max() pass gives the same
+        # answer regardless of entry order, without sorting.
+        return max(
+            (
+                quality
+                for potential_type, quality in weighted_types
+                if potential_type.match(content_type)
+            ),
+            default=0.0,
+        )
+
+    return {content_type: q_for(content_type) for content_type in content_types}
+
+
 def closest_thumbnail_format(
     requested_format: BaseThumbnailFormat,
-    accepts: list[MediaType],
+    accepts: Sequence[MediaType],
     rendered_formats: list[StoredThumbnailFormat],
 ) -> StoredThumbnailFormat:
-    accepted_types = sorted(
-        accepts,
-        key=lambda e: float(e.params.get("q", "1.0")),
-        reverse=True,
+    content_type_quality = content_type_qualities(
+        tuple(accepts),
+        frozenset(possible_format.content_type for possible_format in rendered_formats),
     )
 
-    def q_for(content_type: str) -> float:
-        for potential_type in accepted_types:
-            if potential_type.match(content_type):
-                return float(potential_type.params.get("q", "1.0"))
-        return 0.0
-
     # Serve a "close" format -- preferring animated which
     # matches, followed by the format they requested, or one
     # their browser supports, in the size closest to what they
@@ -231,12 +276,12 @@ def closest_thumbnail_format(
         return (
             possible_format.animated != requested_format.animated,
             possible_format.extension != requested_format.extension,
-            1.0 - q_for(possible_format.content_type),
+            1.0 - content_type_quality[possible_format.content_type],
             abs(requested_format.max_width - possible_format.max_width),
             possible_format.byte_size,
         )
 
-    return sorted(rendered_formats, key=grade_format)[0]
+    return min(rendered_formats, key=grade_format)
 
 
 def serve_file(
@@ -293,23 +338,27 @@ def serve_file(
             return serve_image_error(404, "images/errors/image-not-exist.png")
 
         rendered_formats = [StoredThumbnailFormat(**f) for f in image_attachment.thumbnail_metadata]
+        # Thumbnail formats compare equal exactly when their rendered
+        # strings match, so a set of strings answers the membership
+        # checks below with one hash lookup instead of a scan.
+        rendered_format_strings = {str(rendered) for rendered in rendered_formats}
 
         # We never generate animated versions if the input was still,
         # so filter those out
         if image_attachment.frames == 1:
             potential_output_formats = [
                 thumbnail_format
-                for thumbnail_format in THUMBNAIL_OUTPUT_FORMATS
+                for thumbnail_format in get_thumbnail_output_formats()
                 if not thumbnail_format.animated
             ]
         else:
-            potential_output_formats = THUMBNAIL_OUTPUT_FORMATS
+            potential_output_formats = get_thumbnail_output_formats()
         if requested_format not in potential_output_formats:
             if rendered_formats == []:
                 # We haven't rendered anything, and they requested
                 # something we don't support.
                 return serve_image_error(404, "images/errors/image-not-exist.png")
-            elif requested_format in rendered_formats:
+            elif str(requested_format) in rendered_format_strings:
                 # Not a _current_ format, but we did render it at the time, so fine to serve
                 pass
             else:
@@ -320,9 +369,11 @@ def serve_file(
                 # set, or the client is just guessing a format and
                 # hoping.
                 requested_format = closest_thumbnail_format(
-                    requested_format, request.accepted_types, rendered_formats
+                    requested_format,
+                    sorted_accepted_types(request.headers.get("Accept", "*/*")),
+                    rendered_formats,
                 )
-        elif requested_format not in rendered_formats:
+        elif str(requested_format) not in rendered_format_strings:
             # They requested a valid format, but one we've not
             # rendered yet.  Take a lock on the row, then render every
             # missing format, synchronously.  The lock prevents us
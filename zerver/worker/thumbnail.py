@@ -1,5 +1,6 @@
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
 from io import BytesIO
 from typing import Any
@@ -9,7 +10,12 @@ from django.db import transaction
 from typing_extensions import override
 
 from zerver.lib.mime_types import guess_type
-from zerver.lib.thumbnail import StoredThumbnailFormat, get_image_thumbnail_path, missing_thumbnails
+from zerver.lib.thumbnail import (
+    StoredThumbnailFormat,
+    ThumbnailFormat,
+    get_image_thumbnail_path,
+    missing_thumbnails,
+)
 from zerver.lib.upload import save_attachment_contents, upload_backend
 from zerver.models import ImageAttachment
 from zerver.worker.base import QueueProcessingWorker, assign_queue
@@ -51,12 +57,23 @@ def ensure_thumbnails(image_attachment: ImageAttachment) -> int:
     written_images = 0
     image_bytes = BytesIO()
     save_attachment_contents(image_attachment.path_id, image_bytes)
+
+    # Decode the source at most once per load variant ("all frames"
+    # or "first frame only"), at the largest dimensions any format
+    # needs -- which keeps libvips' shrink-on-load optimization --
+    # and resize the smaller formats from that in-memory image,
+    # rather than re-decoding the original for every format.
+    #
+    # TODO: We could save some computational time by using the same
+    # bytes if multiple resolutions are larger than the source
+    # image.  That is, if the input is 10x10, a 100x100.jpg is
+    # going to be the same as a 200x200.jpg, since those set the
+    # max dimensions, and we do not scale up.
+    max_width = max(t.max_width for t in needed_thumbnails)
+    max_height = max(t.max_height for t in needed_thumbnails)
+    sources: dict[str, pyvips.Image] = {}
     try:
-        # TODO: We could save some computational time by using the same
-        # bytes if multiple resolutions are larger than the source
-        # image.  That is, if the input is 10x10, a 100x100.jpg is
-        # going to be the same as a 200x200.jpg, since those set the
-        # max dimensions, and we do not scale up.
+        resized_images: list[pyvips.Image] = []
         for thumbnail_format in needed_thumbnails:
             # This will scale to fit within the given dimensions; it
             # may be smaller one one or more of them.
@@ -76,16 +93,61 @@ def ensure_thumbnails(image_attachment: ImageAttachment) -> int:
                     load_opts = "n=-1"
                 else:
                     load_opts = "n=1"
-            resized = pyvips.Image.thumbnail_buffer(
-                image_bytes.getbuffer(),
-                thumbnail_format.max_width,
-                height=thumbnail_format.max_height,
-                option_string=load_opts,
-                size=pyvips.Size.DOWN,
-            )
-            thumbnailed_bytes = resized.write_to_buffer(
+            source = sources.get(load_opts)
+            if source is None:
+                source = pyvips.Image.thumbnail_buffer(
+                    image_bytes.getbuffer(),
+                    max_width,
+                    height=max_height,
+                    option_string=load_opts,
+                    size=pyvips.Size.DOWN,
+                )
+                # Sequential loaders (JPEG, PNG) cannot rewind, so a
+                # demand-driven pipeline over one can only be
+                # evaluated once; materialize the decoded pixels so
+                # that every output format can read from them.
+                source = source.copy_memory()
+                sources[load_opts] = source
+            if (thumbnail_format.max_width, thumbnail_format.max_height) == (
+                max_width,
+                max_height,
+            ):
+                resized_images.append(source)
+            else:
+                resized_images.append(
+                    source.thumbnail_image(
+                        thumbnail_format.max_width,
+                        height=thumbnail_format.max_height,
+                        size=pyvips.Size.DOWN,
+                    )
+                )
+
+        def render_format(thumbnail_format: ThumbnailFormat, resized: pyvips.Image) -> bytes:
+            return resized.write_to_buffer(
                 f".{thumbnail_format.extension}[{thumbnail_format.opts}]"
             )
+
+        # The resize pipelines built above share only the
+        # materialized in-memory source, which is safe to read
+        # concurrently, and libvips releases the GIL during resize
+        # and encode, so rendering the formats in a thread pool
+        # parallelizes the actual image work.
+        with ThreadPoolExecutor(max_workers=min(4, len(needed_thumbnails))) as executor:
+            rendered = [
+                executor.submit(render_format, thumbnail_format, resized)
+                for thumbnail_format, resized in zip(needed_thumbnails, resized_images, strict=True)
+            ]
+
+        for thumbnail_format, resized, future in zip(
+            needed_thumbnails, resized_images, rendered, strict=True
+        ):
+            try:
+                thumbnailed_bytes = future.result()
+            except pyvips.Error as e:
+                # One format failing to encode should not discard the
+                # formats which rendered successfully.
+                logger.exception(e)
+                continue
             content_type = guess_type(f"image.{thumbnail_format.extension}")[0]
             assert content_type is not None
             thumbnail_path = get_image_thumbnail_path(image_attachment, thumbnail_format)
@@ -116,12 +178,12 @@ def ensure_thumbnails(image_attachment: ImageAttachment) -> int:
     except pyvips.Error as e:
         logger.exception(e)
 
-        if written_images == 0 and len(image_attachment.thumbnail_metadata) == 0:
-            # We have never thumbnailed this -- it most likely had
-            # bad data.  Remove the ImageAttachment row, since it is
-            # not valid for thumbnailing.
-            image_attachment.delete()
-            return 0
+    if written_images == 0 and len(image_attachment.thumbnail_metadata) == 0:
+        # We have never thumbnailed this -- it most likely had
+        # bad data.  Remove the ImageAttachment row, since it is
+        # not valid for thumbnailing.
+        image_attachment.delete()
+        return 0
 
     image_attachment.save(update_fields=["thumbnail_metadata"])
 